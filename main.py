@@ -20,7 +20,7 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-DATES = ["02/01/2026", "03/01/2026", "04/01/2026"]  # Multiple dates
+DATES = ["01/02/2026", "01/03/2026", "01/04/2026"]  # Multiple dates (MM/DD/YYYY)
 TRAIN_TYPES = ["express", "inter_county"]  # Both types
 CLASSES = ["first", "economy"]  # Monitor both classes
 CHECK_INTERVAL = 60  # Seconds between checks
@@ -86,7 +86,7 @@ class TrainScraper:
         
         Args:
             schedule_type: 'express' or 'inter_county'
-            travel_date: Format DD/MM/YYYY
+            travel_date: Format MM/DD/YYYY (what search-view-results.php accepts)
             terminal_id: Starting station ID
             destination_id: Destination station ID
             departure_time: '3.00', '4.30' or '10.00' for express trains
@@ -270,7 +270,7 @@ if __name__ == "__main__":
     scraper = TrainScraper(csrf_handler)
     
     # Test search
-    find_dates = ["02/01/2026","03/01/2026","04/01/2026","02/01/2026"]
+    find_dates = ["01/02/2026","01/03/2026","01/04/2026","01/02/2026"]
     interested_times = ['3.00','4.30','10.00']
     available_trains = []
     for date in find_dates:
@@ -6,7 +6,15 @@ import time
 import logging
 import schedule
 import asyncio
-from datetime import datetime
+import hashlib
+import threading
+import sqlite3
+import queue
+from collections import deque, namedtuple
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime, time as dt_time, timedelta, timezone
+from urllib.parse import urlsplit, parse_qs
 from dotenv import load_dotenv
 from telegram import Bot
 from telegram.error import TelegramError
@@ -26,6 +34,26 @@ logging.basicConfig(
 )
 logger = logging.getLogger("TrainMonitor")
 
+# Kenya has no DST, so a fixed offset is enough to reason about departure times
+EAT = timezone(timedelta(hours=3))
+
+SearchQuery = namedtuple('SearchQuery', ['route', 'travel_date', 'schedule_type', 'departure_time'])
+
+class Route(namedtuple('Route', ['terminal_id', 'destination_id', 'terminal_name', 'destination_name'])):
+    """A directed station pair to scan"""
+    __slots__ = ()
+
+    @property
+    def key(self):
+        return f"{self.terminal_id}-{self.destination_id}"
+
+    @property
+    def label(self):
+        return f"{self.terminal_name} → {self.destination_name}"
+
+    def reverse(self):
+        return Route(self.destination_id, self.terminal_id, self.destination_name, self.terminal_name)
+
 class ConfigManager:
     """Manage configuration from file and environment variables"""
     
@@ -56,7 +84,45 @@ class ConfigManager:
                 "terminal_id": 3,
                 "destination_id": 2
             },
-            "departure_times": ["3.00", "10.00"]
+            "routes": [],
+            "station_catalog": {
+                "cache_path": "cache/stations.json",
+                "refresh_hours": 24
+            },
+            "token_max_age": 300,
+            "outbox": {
+                "path": "data/outbox.db",
+                "batch_size": 10,
+                "max_attempts": 8,
+                "retry_backoff": 30,
+                "poll_interval": 5,
+                "replay_limit": 20,
+                "replay_max_age": 3600,
+                "retention_days": 14
+            },
+            "departure_times": ["3.00", "10.00"],
+            "horizon": {
+                "days": 0,
+                "weekdays_only": False,
+                "holidays": [],
+                "exclude_holidays": False
+            },
+            "last_departure": "22:00",
+            "hedging": {
+                "enabled": False,
+                "pool_size": 3,
+                "percentile": 95,
+                "min_samples": 20,
+                "initial_delay": None,
+                "budget": 0.1,
+                "window": 200
+            },
+            "api": {
+                "enabled": False,
+                "host": "127.0.0.1",
+                "port": 8080,
+                "long_poll_timeout": 30
+            }
         }
         for key, value in defaults.items():
             if key not in self.config:
@@ -84,6 +150,20 @@ class CSRFHandler:
         self.base_url = "https://metickets.krc.co.ke"
         self.session = requests.Session()
         self.csrf_token = None
+        self.token_fetched_at = None
+        self.index_html = None # Last index.php page, reused by the station catalog
+        self.reuse_tokens = True # Switched off if the site rejects a reused token
+
+    def get_token(self, max_age=0):
+        """Return the current token if younger than max_age seconds, otherwise fetch a new one"""
+        if (self.reuse_tokens and self.csrf_token and max_age > 0
+                and time.monotonic() - self.token_fetched_at < max_age):
+            return self.csrf_token
+        return self.extract_csrf_token()
+
+    def invalidate_token(self):
+        self.csrf_token = None
+        self.token_fetched_at = None
         
     def extract_csrf_token(self):
         """Extract CSRF token from the index page"""
@@ -99,12 +179,14 @@ class CSRFHandler:
                 timeout=30
             )
             response.raise_for_status()
+            self.index_html = response.text
             
             soup = BeautifulSoup(response.text, 'html.parser')
             csrf_input = soup.find('input', {'name': 'csrf_token'})
             
             if csrf_input and csrf_input.get('value'):
                 self.csrf_token = csrf_input.get('value')
+                self.token_fetched_at = time.monotonic()
                 logger.debug(f"CSRF token extracted: {self.csrf_token[:10]}...")
                 return self.csrf_token
             else:
@@ -121,18 +203,209 @@ class CSRFHandler:
     def get_session(self):
         return self.session
 
+class StationCatalog:
+    """Discover station IDs from index.php and cache them on disk"""
+
+    def __init__(self, cache_path='cache/stations.json', refresh_hours=24):
+        self.cache_path = cache_path
+        self.refresh_seconds = refresh_hours * 3600
+        self.stations = {} # station_id -> name
+        self.fetched_at = None
+        self._load_cache()
+
+    def _load_cache(self):
+        try:
+            with open(self.cache_path, 'r') as f:
+                data = json.load(f)
+            self.stations = {int(k): v for k, v in data['stations'].items()}
+            self.fetched_at = datetime.fromisoformat(data['fetched_at'])
+        except FileNotFoundError:
+            pass
+        except (json.JSONDecodeError, KeyError, ValueError) as e:
+            logger.error(f"Ignoring unreadable station cache {self.cache_path}: {e}")
+
+    def _save_cache(self):
+        try:
+            os.makedirs(os.path.dirname(self.cache_path) or '.', exist_ok=True)
+            with open(self.cache_path, 'w') as f:
+                json.dump({
+                    'fetched_at': self.fetched_at.isoformat(timespec='seconds'),
+                    'stations': {str(k): v for k, v in sorted(self.stations.items())}
+                }, f, indent=2)
+        except OSError as e:
+            logger.error(f"Failed to write station cache {self.cache_path}: {e}")
+
+    def is_stale(self):
+        return self.fetched_at is None or (datetime.now() - self.fetched_at).total_seconds() > self.refresh_seconds
+
+    @staticmethod
+    def parse_stations(html):
+        """Read station options from the terminal/destination selects of the search form"""
+        soup = BeautifulSoup(html, 'html.parser')
+        stations = {}
+        for select_name in ('terminal_id', 'destination_id'):
+            select = soup.find('select', {'name': select_name})
+            if not select:
+                continue
+            for option in select.find_all('option'):
+                value = (option.get('value') or '').strip()
+                name = option.text.strip()
+                if value.isdigit() and name:
+                    stations[int(value)] = name
+        return stations
+
+    def refresh(self, csrf_handler):
+        """Re-read the station list if the cache is stale; the page fetch also renews the session token"""
+        if not self.is_stale():
+            return
+        if not csrf_handler.extract_csrf_token() or not csrf_handler.index_html:
+            logger.warning("Could not refresh station catalog, using cached stations")
+            return
+
+        stations = self.parse_stations(csrf_handler.index_html)
+        if not stations:
+            logger.warning("No stations found on index.php, using cached stations")
+            return
+
+        self.stations = stations
+        self.fetched_at = datetime.now()
+        self._save_cache()
+        logger.info(f"Station catalog refreshed: {len(stations)} stations")
+
+    def resolve(self, value):
+        """Turn a station ID or (partial, case-insensitive) name into a station ID"""
+        if value is None:
+            raise ValueError("missing station")
+        if isinstance(value, int) or str(value).strip().isdigit():
+            return int(value)
+
+        wanted = value.strip().lower()
+        matches = [sid for sid, name in self.stations.items() if name.lower() == wanted]
+        if not matches:
+            matches = [sid for sid, name in self.stations.items() if wanted in name.lower()]
+        if len(matches) == 1:
+            return matches[0]
+        if matches:
+            raise ValueError(f"station '{value}' is ambiguous: {', '.join(self.stations[m] for m in matches)}")
+        raise ValueError(f"unknown station '{value}'")
+
+    def name(self, station_id):
+        return self.stations.get(station_id, f"Station {station_id}")
+
 class TrainScraper:
     """Handle train availability requests and HTML retrieval"""
     
-    def __init__(self, csrf_handler):
+    def __init__(self, csrf_handler, hedging=None, token_max_age=0):
         self.csrf_handler = csrf_handler
         self.base_url = "https://metickets.krc.co.ke"
-        
+        self.token_max_age = token_max_age
+        self.hedging = hedging or {}
+        self.latency_lock = threading.Lock()
+        self.latencies = deque(maxlen=self.hedging.get('window', 200))
+        self.stats = {'requests': 0, 'hedges_fired': 0, 'hedges_won': 0, 'hedges_skipped': 0}
+
+        if self.hedging.get('enabled'):
+            # Each pooled session carries its own cookies and CSRF token, so a hedge
+            # never shares a session with the request it duplicates
+            pool_size = max(2, self.hedging.get('pool_size', 3))
+            self.sessions = queue.Queue()
+            self.sessions.put(csrf_handler)
+            for _ in range(pool_size - 1):
+                self.sessions.put(CSRFHandler())
+            self.executor = ThreadPoolExecutor(max_workers=pool_size * 2, thread_name_prefix="search")
+
     def search_trains(self, schedule_type, travel_date, terminal_id, destination_id, departure_time="10.00"):
+        if self.hedging.get('enabled'):
+            return self._hedged_search(schedule_type, travel_date, terminal_id, destination_id, departure_time)
+        return self._search(self.csrf_handler, schedule_type, travel_date, terminal_id, destination_id, departure_time)
+
+    @contextmanager
+    def borrow_session(self):
+        """Check out a session for other index.php work without racing in-flight searches"""
+        if not self.hedging.get('enabled'):
+            yield self.csrf_handler
+            return
+        csrf_handler = self.sessions.get()
         try:
-            csrf_token = self.csrf_handler.extract_csrf_token()
+            yield csrf_handler
+        finally:
+            self.sessions.put(csrf_handler)
+
+    def _hedged_search(self, *search_args):
+        """Send a duplicate on another session if the first hasn't answered by the hedge delay"""
+        self.stats['requests'] += 1
+        # Check out on this thread so time spent waiting for a free session isn't hidden inside the hedge delay
+        primary = self.executor.submit(self._pooled_search, self.sessions.get(), *search_args)
+
+        delay = self._hedge_delay()
+        if delay is None or wait([primary], timeout=delay).done:
+            return primary.result()
+
+        if self.stats['hedges_fired'] + 1 > self.hedging.get('budget', 0.1) * self.stats['requests']:
+            self.stats['hedges_skipped'] += 1
+            return primary.result()
+
+        # Sessions still held by earlier losers mean no spare capacity; don't queue a hedge behind them
+        try:
+            hedge_handler = self.sessions.get_nowait()
+        except queue.Empty:
+            self.stats['hedges_skipped'] += 1
+            return primary.result()
+
+        self.stats['hedges_fired'] += 1
+        hedge = self.executor.submit(self._pooled_search, hedge_handler, *search_args)
+
+        # First successful response wins; the loser finishes in the background
+        pending = {primary, hedge}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                html = future.result()
+                if html is not None:
+                    if future is hedge:
+                        self.stats['hedges_won'] += 1
+                    return html
+        return None
+
+    def _hedge_delay(self):
+        """Observed latency percentile, or the configured initial delay until enough samples exist"""
+        with self.latency_lock:
+            samples = sorted(self.latencies)
+        if len(samples) < self.hedging.get('min_samples', 20):
+            return self.hedging.get('initial_delay')
+        index = int(len(samples) * self.hedging.get('percentile', 95) / 100)
+        return samples[min(index, len(samples) - 1)]
+
+    def _pooled_search(self, csrf_handler, *search_args):
+        """Run a search on a checked-out session and return it to the pool afterwards"""
+        try:
+            return self._search(csrf_handler, *search_args)
+        finally:
+            self.sessions.put(csrf_handler)
+
+    def hedge_summary(self):
+        stats = self.stats
+        win_rate = stats['hedges_won'] / stats['hedges_fired'] if stats['hedges_fired'] else 0
+        delay = self._hedge_delay()
+        delay_text = f"{delay:.2f}s" if delay is not None else "n/a"
+        return (
+            f"Hedging: {stats['hedges_fired']}/{stats['requests']} requests hedged, "
+            f"{stats['hedges_won']} won ({win_rate:.0%}), {stats['hedges_skipped']} skipped (budget or no free session), "
+            f"current delay {delay_text}"
+        )
+
+    def _record_latency(self, started):
+        with self.latency_lock:
+            self.latencies.append(time.monotonic() - started)
+
+    def _search(self, csrf_handler, schedule_type, travel_date, terminal_id, destination_id, departure_time):
+        try:
+            started = time.monotonic()
+            previous_fetch = csrf_handler.token_fetched_at
+            csrf_token = csrf_handler.get_token(self.token_max_age)
             if not csrf_token:
                 return None
+            reused = previous_fetch is not None and csrf_handler.token_fetched_at == previous_fetch
             
             form_data = {
                 'csrf_token': csrf_token,
@@ -154,24 +427,141 @@ class TrainScraper:
             
             # logger.info(f"Searching {schedule_type} trains for {travel_date} at {departure_time}...")
             
-            response = self.csrf_handler.get_session().post(
+            response = csrf_handler.get_session().post(
                 f"{self.base_url}/search-view-results.php",
                 data=form_data,
                 headers=headers,
                 timeout=30
             )
             response.raise_for_status()
+
+            if reused and not AvailabilityChecker.is_results_page(response.text):
+                # The site did not accept the shared token; stop reusing on this session and retry once
+                logger.warning("Reused CSRF token was rejected, fetching a fresh token per search on this session")
+                csrf_handler.reuse_tokens = False
+                csrf_handler.invalidate_token()
+                return self._search(csrf_handler, schedule_type, travel_date, terminal_id, destination_id, departure_time)
+
+            self._record_latency(started)
             return response.text
             
         except requests.exceptions.RequestException as e:
+            # Timeouts and errors are the tail hedging exists for; keep them in the percentile window
+            self._record_latency(started)
             logger.error(f"Error searching trains: {e}")
             return None
         except Exception as e:
             logger.error(f"Unexpected error in train search: {e}")
             return None
 
+class QueryGenerator:
+    """Build the set of still-bookable search queries for each check cycle"""
+
+    # search-view-results.php expects MM/DD/YYYY
+    SEARCH_DATE_FORMAT = '%m/%d/%Y'
+    INPUT_DATE_FORMATS = ('%Y-%m-%d', '%m/%d/%Y')
+
+    def __init__(self, config_manager):
+        self.config_manager = config_manager
+        self.active_dates = set()
+
+    @classmethod
+    def parse_date(cls, value):
+        """Parse a configured date in ISO (YYYY-MM-DD) or KRC (MM/DD/YYYY) form"""
+        for fmt in cls.INPUT_DATE_FORMATS:
+            try:
+                return datetime.strptime(value.strip(), fmt).date()
+            except ValueError:
+                continue
+        raise ValueError(f"Unrecognised date '{value}', use YYYY-MM-DD or MM/DD/YYYY")
+
+    def _parse_dates(self, values):
+        dates = set()
+        for value in values:
+            try:
+                dates.add(self.parse_date(value))
+            except ValueError as e:
+                logger.error(f"Ignoring configured date: {e}")
+        return dates
+
+    def _last_departure(self):
+        value = self.config_manager.get('last_departure', '22:00')
+        try:
+            return datetime.strptime(value, '%H:%M').time()
+        except ValueError:
+            logger.error(f"Invalid last_departure '{value}', falling back to 22:00")
+            return dt_time(22, 0)
+
+    def _horizon_dates(self, today):
+        """Dates in the rolling horizon starting today
+
+        `weekdays_only` skips Saturdays and Sundays, but a listed holiday on a weekend is still
+        scanned. `exclude_holidays` skips every listed holiday. With both off, `holidays` has no effect.
+        """
+        horizon = self.config_manager.get('horizon', {})
+        days = horizon.get('days', 0)
+        holidays = self._parse_dates(horizon.get('holidays', []))
+        dates = set()
+
+        for offset in range(days):
+            day = today + timedelta(days=offset)
+            if horizon.get('exclude_holidays') and day in holidays:
+                continue
+            # Holidays are kept on weekdays-only horizons unless explicitly excluded
+            if horizon.get('weekdays_only') and day.weekday() >= 5 and day not in holidays:
+                continue
+            dates.add(day)
+        return dates
+
+    def bookable_dates(self, now=None):
+        """Return the configured and rolling dates whose last departure is still ahead"""
+        now = now or datetime.now(EAT)
+        today = now.date()
+        last_departure = self._last_departure()
+
+        candidates = self._parse_dates(self.config_manager.get('dates', []))
+        candidates |= self._horizon_dates(today)
+
+        bookable = sorted(
+            day for day in candidates
+            if datetime.combine(day, last_departure, tzinfo=EAT) > now
+        )
+
+        expired = self.active_dates - set(bookable)
+        if expired:
+            logger.info(f"Dropping departed dates: {', '.join(d.isoformat() for d in sorted(expired))}")
+        self.active_dates = set(bookable)
+        return bookable
+
+    def departure_times_for(self, schedule_type):
+        if schedule_type == 'inter_county':
+            return ["08.00"] # Usually starts early
+        return self.config_manager.get('departure_times')
+
+    def generate(self, routes, now=None):
+        """Return the SearchQuery list for one cycle across all routes"""
+        queries = []
+        for day in self.bookable_dates(now):
+            travel_date = day.strftime(self.SEARCH_DATE_FORMAT)
+            for route in routes:
+                for schedule_type in self.config_manager.get('train_types'):
+                    for departure_time in self.departure_times_for(schedule_type):
+                        queries.append(SearchQuery(route, travel_date, schedule_type, departure_time))
+        return queries
+
 class AvailabilityChecker:
     """Determine seat availability by class"""
+
+    @staticmethod
+    def is_results_page(html_content):
+        """True only for pages check_availability can read: a train list or an explicit Fully Booked"""
+        if not html_content:
+            return False
+        soup = BeautifulSoup(html_content, 'html.parser')
+        if soup.find('div', id='form-tags'):
+            return True
+        fully_booked = soup.find('h4', class_='main-message')
+        return bool(fully_booked and 'Fully Booked' in fully_booked.text)
     
     @staticmethod
     def check_availability(html_content):
@@ -313,27 +703,36 @@ class TelegramNotifier:
         self.channel_id = channel_id
         self.sent_alerts = set() # To avoid duplicate alerts for same train/date/time in short window
 
-    async def send_notifications(self, message):
-        """Send message to configured chat and channel"""
-        bot = Bot(token=self.token)
+    @property
+    def destinations(self):
+        """Chat IDs every alert goes to: the configured chat and, if set, the channel"""
+        return [chat_id for chat_id in (self.chat_id, self.channel_id) if chat_id]
+
+    async def deliver_batch(self, entries):
+        """Send outbox entries in order; return delivered IDs and (ID, error) failures"""
+        delivered, failed = [], []
         try:
-            await bot.send_message(chat_id=self.chat_id, text=message, parse_mode='Markdown')
-            logger.info("Telegram notification sent.")
+            bot = Bot(token=self.token)
         except Exception as e:
-            logger.error(f"Failed to send Telegram message: {e}")
-            
-        if self.channel_id:
+            logger.error(f"Failed to create Telegram bot: {e}")
+            return delivered, [(entry['id'], str(e)) for entry in entries]
+
+        for entry in entries:
             try:
-                await bot.send_message(chat_id=self.channel_id, text=message, parse_mode='Markdown')
-                logger.info("Telegram notification sent to channel.")
+                await bot.send_message(chat_id=entry['chat_id'], text=entry['message'], parse_mode='Markdown')
+                delivered.append(entry['id'])
+                logger.info(f"Telegram notification sent to {entry['chat_id']}.")
             except Exception as e:
-                logger.error(f"Failed to forward message to channel: {e}")
+                logger.error(f"Failed to send Telegram message to {entry['chat_id']}: {e}")
+                failed.append((entry['id'], str(e)))
+        return delivered, failed
 
-    def format_alert(self, train, date, schedule_type):
+    def format_alert(self, train, date, schedule_type, route=None):
+        route_line = f"*Route:* {route.label}\n" if route else ""
         return f"""
 🚂 *TRAIN AVAILABLE ALERT!* 🚂
 
-*Date:* {date}
+{route_line}*Date:* {date}
 *Train:* {train.get('name', 'Unknown')} ({schedule_type})
 *Departure:* {train.get('departure', 'N/A')}
 *Arrival:* {train.get('arrival', 'N/A')}
@@ -345,85 +744,550 @@ class TelegramNotifier:
 *Book Now:* https://metickets.krc.co.ke
 """
 
+class NotificationOutbox:
+    """Durable SQLite outbox: alerts are written before sending and acknowledged after"""
+
+    ACTIVE = "('pending', 'sending')"
+
+    def __init__(self, path='data/outbox.db', max_attempts=8, retry_backoff=30, lease=300):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        self.lease = lease # Seconds a claimed entry stays reserved before it can be retried
+        self.conn = sqlite3.connect(path)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=FULL")
+        with self.conn:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS outbox (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    idempotency_key TEXT NOT NULL UNIQUE,
+                    chat_id TEXT NOT NULL,
+                    message TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    created_at REAL NOT NULL,
+                    next_attempt_at REAL NOT NULL,
+                    sent_at REAL,
+                    last_error TEXT
+                )
+            """)
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, next_attempt_at)"
+            )
+
+    def enqueue(self, alert_key, message, chat_ids):
+        """Record one entry per destination; returns how many were new"""
+        now = time.time()
+        before = self.conn.total_changes
+        with self.conn:
+            for chat_id in chat_ids:
+                # Existing keys are left alone, including entries recovery expired to bound a replay
+                self.conn.execute("""
+                    INSERT INTO outbox (idempotency_key, chat_id, message, created_at, next_attempt_at)
+                    VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT (idempotency_key) DO NOTHING
+                """, (f"{alert_key}|{chat_id}", str(chat_id), message, now, now))
+        return self.conn.total_changes - before
+
+    def claim_due(self, limit):
+        """Reserve up to `limit` due entries for sending, oldest first"""
+        now = time.time()
+        with self.conn:
+            rows = self.conn.execute(f"""
+                SELECT id, idempotency_key, chat_id, message, attempts FROM outbox
+                WHERE status IN {self.ACTIVE} AND next_attempt_at <= ?
+                ORDER BY id LIMIT ?
+            """, (now, limit)).fetchall()
+            self.conn.executemany(
+                "UPDATE outbox SET status = 'sending', attempts = attempts + 1, next_attempt_at = ? WHERE id = ?",
+                [(now + self.lease, row['id']) for row in rows]
+            )
+        return [dict(row, attempts=row['attempts'] + 1) for row in rows]
+
+    def ack(self, entry_ids):
+        """Mark a batch of entries delivered in a single transaction"""
+        if not entry_ids:
+            return
+        with self.conn:
+            self.conn.executemany(
+                "UPDATE outbox SET status = 'sent', sent_at = ?, last_error = NULL WHERE id = ?",
+                [(time.time(), entry_id) for entry_id in entry_ids]
+            )
+
+    def retry_later(self, entry_id, attempts, error):
+        """Schedule a failed entry with exponential backoff; it stops growing after max_attempts but never gives up"""
+        if attempts == self.max_attempts:
+            logger.error(f"Outbox entry {entry_id} still failing after {attempts} attempts, retrying at capped backoff: {error}")
+        delay = min(self.retry_backoff * 2 ** (min(attempts, self.max_attempts) - 1), 3600)
+        with self.conn:
+            self.conn.execute(
+                "UPDATE outbox SET status = 'pending', next_attempt_at = ?, last_error = ? WHERE id = ?",
+                (time.time() + delay, error, entry_id)
+            )
+
+    def recover(self, replay_limit=20, replay_max_age=3600, retention_days=14):
+        """Bound what a restart replays: expire stale or excess undelivered entries, retry interrupted sends"""
+        now = time.time()
+        with self.conn:
+            too_old = self.conn.execute(f"""
+                UPDATE outbox SET status = 'expired'
+                WHERE status IN {self.ACTIVE} AND created_at < ?
+            """, (now - replay_max_age,)).rowcount
+            overflow = self.conn.execute(f"""
+                UPDATE outbox SET status = 'expired'
+                WHERE status IN {self.ACTIVE} AND id NOT IN (
+                    SELECT id FROM outbox WHERE status IN {self.ACTIVE} ORDER BY id DESC LIMIT ?
+                )
+            """, (replay_limit,)).rowcount
+            # A crash between send and ack leaves entries 'sending'; resend rather than risk losing them
+            interrupted = self.conn.execute(
+                "UPDATE outbox SET status = 'pending', next_attempt_at = ? WHERE status = 'sending'", (now,)
+            ).rowcount
+            replay = self.conn.execute(
+                f"SELECT COUNT(*) FROM outbox WHERE status IN {self.ACTIVE}"
+            ).fetchone()[0]
+            self.conn.execute(
+                "DELETE FROM outbox WHERE status IN ('sent', 'expired') AND created_at < ?",
+                (now - retention_days * 86400,)
+            )
+        logger.info(
+            f"Outbox recovery: replaying {replay} alerts ({interrupted} interrupted), "
+            f"expired {too_old} stale and {overflow} over the replay limit"
+        )
+
+class SnapshotIndex:
+    """In-memory index of the latest parsed results, keyed by route, date, type and departure"""
+
+    def __init__(self, max_tombstones=1000):
+        self.lock = threading.Lock()
+        self.version = 0
+        self.entries = {}
+        self.tombstones = {} # Removed keys, kept so long-poll clients see deletions
+        self.pruned_version = 0 # Changes at or below this version may have been forgotten
+        self.max_tombstones = max_tombstones
+        self.listeners = []
+
+    @staticmethod
+    def make_key(route, date, schedule_type, departure):
+        return f"{route}|{date}|{schedule_type}|{departure}"
+
+    def add_listener(self, callback):
+        """Register a callback invoked with the new version after every change"""
+        with self.lock:
+            self.listeners.append(callback)
+
+    def update_query(self, route, date, schedule_type, query_time, trains):
+        """Replace the entries produced by one search query with its latest results"""
+        now = datetime.now(EAT).isoformat(timespec='seconds')
+        query = (route, date, schedule_type, query_time)
+        changed = False
+
+        with self.lock:
+            seen = set()
+            for train in trains:
+                departure = train.get('departure') or query_time
+                key = self.make_key(route, date, schedule_type, departure)
+                seen.add(key)
+
+                entry = self.entries.get(key)
+                if entry and entry['train'] == train:
+                    entry['checked_at'] = now
+                    continue
+
+                self.version += 1
+                changed = True
+                self.tombstones.pop(key, None)
+                self.entries[key] = {
+                    'key': key,
+                    'route': route,
+                    'date': date,
+                    'schedule_type': schedule_type,
+                    'departure': departure,
+                    'query_time': query_time,
+                    'train': dict(train),
+                    'changed_at': now,
+                    'checked_at': now,
+                    'version': self.version
+                }
+
+            # Trains this query returned before but not now have sold out or vanished
+            for key, entry in list(self.entries.items()):
+                if key in seen:
+                    continue
+                if (entry['route'], entry['date'], entry['schedule_type'], entry['query_time']) != query:
+                    continue
+                self._remove(key, now)
+                changed = True
+
+            self._prune_tombstones()
+            version = self.version
+            listeners = list(self.listeners)
+
+        if changed:
+            self._notify(listeners, version)
+
+    def retain(self, active):
+        """Drop entries whose (route, date) is no longer queried, e.g. departed dates or removed routes"""
+        now = datetime.now(EAT).isoformat(timespec='seconds')
+        with self.lock:
+            stale = [key for key, entry in self.entries.items() if (entry['route'], entry['date']) not in active]
+            for key in stale:
+                self._remove(key, now)
+            self._prune_tombstones()
+            version = self.version
+            listeners = list(self.listeners)
+
+        if stale:
+            logger.info(f"Removed {len(stale)} snapshot entries no longer being queried")
+            self._notify(listeners, version)
+
+    def _remove(self, key, now):
+        del self.entries[key]
+        self.version += 1
+        self.tombstones[key] = {
+            'key': key,
+            'removed': True,
+            'changed_at': now,
+            'version': self.version
+        }
+
+    @staticmethod
+    def _notify(listeners, version):
+        for callback in listeners:
+            try:
+                callback(version)
+            except Exception as e:
+                logger.error(f"Snapshot listener failed: {e}")
+
+    def _prune_tombstones(self):
+        if len(self.tombstones) <= self.max_tombstones:
+            return
+        ordered = sorted(self.tombstones.values(), key=lambda t: t['version'])
+        for tombstone in ordered[:len(ordered) - self.max_tombstones]:
+            del self.tombstones[tombstone['key']]
+            self.pruned_version = max(self.pruned_version, tombstone['version'])
+
+    def snapshot(self, route=None, date=None, schedule_type=None):
+        """Return the current entries, optionally filtered"""
+        with self.lock:
+            entries = [
+                dict(entry) for entry in self.entries.values()
+                if (route is None or entry['route'] == route)
+                and (date is None or entry['date'] == date)
+                and (schedule_type is None or entry['schedule_type'] == schedule_type)
+            ]
+            version = self.version
+        entries.sort(key=lambda e: (e['route'], e['date'], e['schedule_type'], e['departure']))
+        return {'version': version, 'entries': entries}
+
+    def changes_since(self, since):
+        """Return entries and removals newer than `since`, or None if a full resync is needed"""
+        with self.lock:
+            if since < self.pruned_version or since > self.version:
+                return None
+            changes = [dict(e) for e in self.entries.values() if e['version'] > since]
+            changes += [dict(t) for t in self.tombstones.values() if t['version'] > since]
+            version = self.version
+        changes.sort(key=lambda c: c['version'])
+        return {'version': version, 'changes': changes}
+
+class AvailabilityAPI:
+    """Serve the snapshot index as a lightweight read-only HTTP/JSON API"""
+
+    STATUS_TEXT = {
+        200: 'OK',
+        304: 'Not Modified',
+        400: 'Bad Request',
+        404: 'Not Found',
+        405: 'Method Not Allowed'
+    }
+
+    def __init__(self, index, host='127.0.0.1', port=8080, long_poll_timeout=30):
+        self.index = index
+        self.host = host
+        self.port = port
+        self.long_poll_timeout = long_poll_timeout
+        self.loop = None
+        self.changed = None
+
+    def start(self):
+        """Run the server on its own event loop in a daemon thread"""
+        thread = threading.Thread(target=self._run, name="AvailabilityAPI", daemon=True)
+        thread.start()
+
+    def _run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.changed = asyncio.Event()
+        try:
+            self.loop.run_until_complete(asyncio.start_server(self._handle, self.host, self.port))
+        except OSError as e:
+            logger.error(f"Failed to start availability API on {self.host}:{self.port}: {e}")
+            return
+        self.index.add_listener(self._on_change)
+        logger.info(f"Availability API listening on http://{self.host}:{self.port}")
+        self.loop.run_forever()
+
+    def _on_change(self, version):
+        # Called from the monitor thread; hop onto the server loop to wake long-pollers
+        self.loop.call_soon_threadsafe(self._wake)
+
+    def _wake(self):
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 10)
+            headers = {}
+            while True:
+                line = await asyncio.wait_for(reader.readline(), 10)
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+
+            parts = request_line.decode('latin-1').split()
+            if len(parts) < 2:
+                return
+            method, target = parts[0].upper(), parts[1]
+
+            status, payload, extra_headers = await self._dispatch(method, target, headers)
+            await self._respond(writer, method, status, payload, extra_headers)
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        except Exception as e:
+            logger.error(f"Error handling API request: {e}")
+        finally:
+            writer.close()
+
+    async def _dispatch(self, method, target, headers):
+        if method not in ('GET', 'HEAD'):
+            return 405, {'error': 'method not allowed'}, {'Allow': 'GET, HEAD'}
+
+        url = urlsplit(target)
+        params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+
+        if url.path == '/availability':
+            snapshot = self.index.snapshot(
+                route=params.get('route'),
+                date=params.get('date'),
+                schedule_type=params.get('type')
+            )
+            # Only content changes bump an entry's version; re-checks and other routes leave the ETag alone
+            fingerprint = [(entry['key'], entry['version']) for entry in snapshot['entries']]
+            etag = '"' + hashlib.sha1(self._encode(fingerprint)).hexdigest() + '"'
+            if_none_match = headers.get('if-none-match', '')
+            if if_none_match.strip() == '*' or etag in [t.strip() for t in if_none_match.split(',')]:
+                return 304, None, {'ETag': etag}
+            return 200, snapshot, {'ETag': etag}
+
+        if url.path == '/changes':
+            try:
+                since = int(params.get('since', 0))
+                timeout = min(float(params.get('timeout', self.long_poll_timeout)), self.long_poll_timeout)
+            except ValueError:
+                return 400, {'error': 'since and timeout must be numeric'}, {}
+            return 200, await self._wait_for_changes(since, timeout), {}
+
+        return 404, {'error': 'not found'}, {}
+
+    async def _wait_for_changes(self, since, timeout):
+        """Long-poll until the index moves past `since` or the timeout expires"""
+        deadline = self.loop.time() + timeout
+        # A `since` ahead of the index comes from a previous run; answer with the reset straight away
+        while self.index.version == since:
+            remaining = deadline - self.loop.time()
+            if remaining <= 0:
+                break
+            try:
+                await asyncio.wait_for(self.changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                break
+
+        changes = self.index.changes_since(since)
+        if changes is None:
+            # Client is too far behind (or from a previous run): hand it a full snapshot
+            snapshot = self.index.snapshot()
+            return {'version': snapshot['version'], 'reset': True, 'changes': snapshot['entries']}
+        changes['reset'] = False
+        return changes
+
+    @staticmethod
+    def _encode(payload):
+        return json.dumps(payload, sort_keys=True).encode('utf-8')
+
+    async def _respond(self, writer, method, status, payload, extra_headers):
+        body = self._encode(payload) if payload is not None else b''
+        lines = [
+            f"HTTP/1.1 {status} {self.STATUS_TEXT.get(status, '')}",
+            "Content-Type: application/json",
+            f"Content-Length: {len(body)}",
+            "Cache-Control: no-cache",
+            "Connection: close"
+        ]
+        lines += [f"{name}: {value}" for name, value in extra_headers.items()]
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        if method != 'HEAD':
+            writer.write(body)
+        await writer.drain()
+
 class TrainMonitor:
     def __init__(self):
         self.config_manager = ConfigManager()
         self.csrf_handler = CSRFHandler()
-        self.scraper = TrainScraper(self.csrf_handler)
+        self.scraper = TrainScraper(
+            self.csrf_handler,
+            self.config_manager.get('hedging'),
+            token_max_age=self.config_manager.get('token_max_age', 0)
+        )
+        catalog_config = self.config_manager.get('station_catalog', {})
+        self.station_catalog = StationCatalog(
+            cache_path=catalog_config.get('cache_path', 'cache/stations.json'),
+            refresh_hours=catalog_config.get('refresh_hours', 24)
+        )
         self.notifier = TelegramNotifier(
             self.config_manager.telegram_token,
             self.config_manager.telegram_chat_id,
             self.config_manager.telegram_channel_id
         )
         self.available_cache = set() # Store (date, time, train_name) to avoid spamming
+        self.snapshot_index = SnapshotIndex()
+        self.query_generator = QueryGenerator(self.config_manager)
+        outbox_config = self.config_manager.get('outbox', {})
+        self.outbox = NotificationOutbox(
+            path=outbox_config.get('path', 'data/outbox.db'),
+            max_attempts=outbox_config.get('max_attempts', 8),
+            retry_backoff=outbox_config.get('retry_backoff', 30)
+        )
+
+    def resolve_routes(self):
+        """Build the routes to scan from `routes` (or the legacy `route`)
+
+        Each route gives `terminal_id`/`destination_id` or `from`/`to` station names. Set
+        `"return": true` on a route to also scan the reverse leg; it doubles that route's requests.
+        """
+        configured = self.config_manager.get('routes') or [self.config_manager.get('route')]
+        routes = []
+        for spec in configured:
+            try:
+                terminal_id = self.station_catalog.resolve(spec.get('terminal_id', spec.get('from')))
+                destination_id = self.station_catalog.resolve(spec.get('destination_id', spec.get('to')))
+            except ValueError as e:
+                logger.error(f"Skipping route {spec}: {e}")
+                continue
+
+            route = Route(
+                terminal_id,
+                destination_id,
+                spec.get('terminal_name') or self.station_catalog.name(terminal_id),
+                spec.get('destination_name') or self.station_catalog.name(destination_id)
+            )
+            for leg in ([route, route.reverse()] if spec.get('return') else [route]):
+                if leg.key not in [r.key for r in routes]:
+                    routes.append(leg)
+        return routes
 
     def check_job(self):
       try:
-        dates = self.config_manager.get('dates')
-        train_types = self.config_manager.get('train_types')
-        route = self.config_manager.get('route')
-        departure_times = self.config_manager.get('departure_times')
-
-        logger.info(f"Starting check cycle for {len(dates)} dates...")
-
-        for date in dates:
-            for schedule_type in train_types:
-                # For express, we might need to check specific times if required, 
-                # but usually the search returns all for that type? 
-                # The form has a departure_time field.
-                # If schedule_type is express, we iterate times.
-                # If inter_county, usually time doesn't matter as much or there's only one?
-                # The user plan says: depature_time can be "3.00" or "10.00" for Express trains
-                
-                times_to_check = departure_times if schedule_type == 'express' else ["08.00"] # Default for inter_county? Or just one check.
-                # Actually, let's just use the times from config for express, and maybe a default for others.
-                # If inter_county, the time param might be ignored or standard.
-                
-                if schedule_type == 'inter_county':
-                    times_to_check = ["08.00"] # Usually starts early
-
-                for time_val in times_to_check:
-                    html = self.scraper.search_trains(
-                        schedule_type=schedule_type,
-                        travel_date=date,
-                        terminal_id=route['terminal_id'],
-                        destination_id=route['destination_id'],
-                        departure_time=time_val
-                    )
-                    
-                    is_available, trains = AvailabilityChecker.check_availability(html)
-                    
-                    if is_available and trains:
-                        for train in trains:
-                            # Check if we should alert
-                            # We alert if we haven't alerted for this specific train/date recently
-                            # or if seats changed significantly? For now, just alert.
-                            
-                            # Simple de-duplication key
-                            cache_key = f"{date}_{train.get('name')}_{train.get('departure')}_fclass{train.get('first_class_seats', 0)}_eco{train.get('economy_seats', 0)}"
-                            
-                            if cache_key not in self.available_cache:
-                                message = self.notifier.format_alert(train, date, schedule_type)
-                                asyncio.run(self.notifier.send_notifications(message))
-                                self.available_cache.add(cache_key)
-                                logger.info(f"Alert sent for {cache_key}")
-                            else:
-                                logger.info(f"Already alerted for {cache_key}, skipping.")
+        with self.scraper.borrow_session() as csrf_handler:
+            self.station_catalog.refresh(csrf_handler)
+        routes = self.resolve_routes()
+        queries = self.query_generator.generate(routes)
+        self.snapshot_index.retain({(q.route.key, q.travel_date) for q in queries})
+
+        logger.info(
+            f"Starting check cycle: {len(queries)} requests across "
+            f"{len(set(q.travel_date for q in queries))} bookable dates on {len(routes)} routes..."
+        )
+
+        for query in queries:
+            route = query.route
+            html = self.scraper.search_trains(
+                schedule_type=query.schedule_type,
+                travel_date=query.travel_date,
+                terminal_id=route.terminal_id,
+                destination_id=route.destination_id,
+                departure_time=query.departure_time
+            )
+            date, schedule_type = query.travel_date, query.schedule_type
+
+            is_available, trains = AvailabilityChecker.check_availability(html)
+
+            # Failed requests, maintenance pages or token errors say nothing about availability;
+            # keep the last known entries rather than churning the index
+            if AvailabilityChecker.is_results_page(html):
+                self.snapshot_index.update_query(
+                    route.key, date, schedule_type, query.departure_time, trains if is_available else []
+                )
+
+            if is_available and trains:
+                for train in trains:
+                    # Check if we should alert
+                    # We alert if we haven't alerted for this specific train/date recently
+                    # or if seats changed significantly? For now, just alert.
+
+                    # Simple de-duplication key
+                    cache_key = f"{route.key}_{date}_{train.get('name')}_{train.get('departure')}_fclass{train.get('first_class_seats', 0)}_eco{train.get('economy_seats', 0)}"
+
+                    if cache_key not in self.available_cache:
+                        message = self.notifier.format_alert(train, date, schedule_type, route)
+                        # Persist before sending; the outbox key also dedups across restarts
+                        if self.outbox.enqueue(cache_key, message, self.notifier.destinations):
+                            logger.info(f"Alert queued for {cache_key}")
+                            self.deliver_job()
+                        else:
+                            logger.info(f"Already alerted for {cache_key}, skipping.")
+                        self.available_cache.add(cache_key)
                     else:
-                        # Clear from cache if it becomes unavailable? 
-                        
-                        # Or maybe we want to alert again if it reappears?
-                        
-                        # For now, let's keep it simple. If it was available and now isn't, remove from cache.
-                        # But we don't know which specific train is unavailable if we get "Fully Booked".
-                        # So maybe clear cache for this date/time query if fully booked.
-                        pass
+                        logger.info(f"Already alerted for {cache_key}, skipping.")
+
+        if self.scraper.hedging.get('enabled'):
+            logger.info(self.scraper.hedge_summary())
       except Exception as e:
           logger.error(f"Error processing train availability: {e}")
 
+    def deliver_job(self):
+        """Send due outbox entries, acknowledging each batch once it has gone out"""
+        batch_size = self.config_manager.get('outbox', {}).get('batch_size', 10)
+        try:
+            while True:
+                entries = self.outbox.claim_due(batch_size)
+                if not entries:
+                    break
+                delivered, failed = asyncio.run(self.notifier.deliver_batch(entries))
+                self.outbox.ack(delivered)
+                attempts = {entry['id']: entry['attempts'] for entry in entries}
+                for entry_id, error in failed:
+                    self.outbox.retry_later(entry_id, attempts[entry_id], error)
+                if failed:
+                    break # Leave the rest to the next run so backoff applies
+        except Exception as e:
+            logger.error(f"Error delivering notifications: {e}")
+
     def run(self):
         interval = self.config_manager.get('check_interval', 60)
         logger.info(f"Starting monitor with {interval}s interval")
+
+        outbox_config = self.config_manager.get('outbox', {})
+        self.outbox.recover(
+            replay_limit=outbox_config.get('replay_limit', 20),
+            replay_max_age=outbox_config.get('replay_max_age', 3600),
+            retention_days=outbox_config.get('retention_days', 14)
+        )
+        self.deliver_job()
+        schedule.every(outbox_config.get('poll_interval', 5)).seconds.do(self.deliver_job)
+
+        api_config = self.config_manager.get('api', {})
+        if api_config.get('enabled'):
+            AvailabilityAPI(
+                self.snapshot_index,
+                host=api_config.get('host', '127.0.0.1'),
+                port=api_config.get('port', 8080),
+                long_poll_timeout=api_config.get('long_poll_timeout', 30)
+            ).start()
         
         # Run immediately once
         self.check_job()